@@ -131,12 +131,20 @@ import os
 import uuid
 import json
 import io
+import asyncio
 import time
-from datetime import datetime
+import atexit
+import signal
+import sys
+import threading
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import gradio as gr
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import soundfile as sf
-from huggingface_hub import HfApi
+from huggingface_hub import HfApi, CommitOperationAdd
 
 # -------------------------
 # Load environment variables
@@ -144,8 +152,23 @@ from huggingface_hub import HfApi
 load_dotenv()
 HF_TOKEN = os.environ.get("HF_TOKEN")
 REPO_ID = os.environ.get("HF_REPO_ID")
-REPO_SUBFOLDER = os.environ.get("HF_REPO_SUBFOLDER", "data")
-MANIFEST_FILENAME = "dataset.jsonl"
+# Parquet shards get their own folder (data/ holds the legacy per-file .flac/.json uploads),
+# and the dataset card written by casting.py declares this folder as part of the train split
+SHARD_SUBFOLDER = os.environ.get("HF_SHARD_SUBFOLDER", "submissions")
+# Number of submissions Gradio is allowed to process at the same time
+SUBMIT_CONCURRENCY = int(os.environ.get("SUBMIT_CONCURRENCY", "16"))
+# libFLAC compression level 0 (fastest) .. 8 (smallest); low levels keep request latency down
+FLAC_LEVEL = min(8, max(0, int(os.environ.get("FLAC_LEVEL", "1"))))
+# Leading/trailing samples at or below this amplitude (in int16 units, scaled for float input)
+# are trimmed as silence
+SILENCE_THRESHOLD = int(os.environ.get("SILENCE_THRESHOLD", "32"))
+# Queued submissions are written as one parquet shard once this many are pending,
+# or every COMMIT_INTERVAL seconds
+COMMIT_BATCH_ROWS = int(os.environ.get("COMMIT_BATCH_ROWS", "256"))
+COMMIT_INTERVAL = float(os.environ.get("COMMIT_INTERVAL", "30"))
+# Every shard is saved here before it is committed and removed once the commit succeeds,
+# so whatever is left after a crash or failed shutdown may still need uploading by hand
+SPILL_DIR = os.environ.get("SPILL_DIR", "unsent_submissions")
 
 if not HF_TOKEN or not REPO_ID:
     raise EnvironmentError("HF_TOKEN and HF_REPO_ID must be set in .env")
@@ -155,69 +178,269 @@ if not HF_TOKEN or not REPO_ID:
 # -------------------------
 # HF_HUB_HTTP_TIMEOUT from .env will be automatically used
 hf = HfApi()
+# huggingface_hub keeps one keep-alive session per thread; all regular commits run on
+# the single commit worker thread below, so its session (and TLS connection) is reused
 
 # -------------------------
-# Safe upload function
+# Parquet shard layout
 # -------------------------
-def safe_upload(fileobj, path_in_repo):
-    """Retry HuggingFace uploads to avoid timeout crashes."""
+# "audio" uses the struct<bytes, path> layout of datasets' Audio feature, and the
+# "huggingface" schema metadata declares it as such, so once the dataset card lists
+# SHARD_SUBFOLDER (see casting.py) the shards load with a playable audio column.
+PARQUET_FEATURES = {
+    "id": {"dtype": "string", "_type": "Value"},
+    "audio": {"_type": "Audio"},
+    "transcript": {"dtype": "string", "_type": "Value"},
+    "speaker_id": {"dtype": "string", "_type": "Value"},
+    "language": {"dtype": "string", "_type": "Value"},
+    "timestamp": {"dtype": "string", "_type": "Value"},
+}
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("audio", pa.struct([("bytes", pa.binary()), ("path", pa.string())])),
+        ("transcript", pa.string()),
+        ("speaker_id", pa.string()),
+        ("language", pa.string()),
+        ("timestamp", pa.string()),
+    ],
+    metadata={"huggingface": json.dumps({"info": {"features": PARQUET_FEATURES}})},
+)
+
+
+def write_parquet_shard(rows):
+    """Serialize queued submission rows into parquet file bytes."""
+    table = pa.Table.from_pylist(rows, schema=PARQUET_SCHEMA)
+    buf = io.BytesIO()
+    # FLAC audio is already compressed, so dictionary encoding would only add overhead
+    pq.write_table(table, buf, compression="zstd", use_dictionary=False)
+    return buf.getvalue()
+
+# -------------------------
+# Safe commit function
+# -------------------------
+def safe_commit(files):
+    """Retry HuggingFace commits to avoid timeout crashes."""
+    operations = [
+        CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=data)
+        for path_in_repo, data in files
+    ]
     for attempt in range(3):
         try:
-            return hf.upload_file(
-                path_or_fileobj=fileobj,
-                path_in_repo=path_in_repo,
+            return hf.create_commit(
                 repo_id=REPO_ID,
+                repo_type="dataset",
                 token=HF_TOKEN,
-                repo_type="dataset"
+                operations=operations,
+                commit_message=f"Add {len(files)} files"
             )
         except Exception as e:
             if attempt == 2:
                 raise
-            print(f"Upload failed, retrying... ({attempt+1}/3)")
+            print(f"Commit failed, retrying... ({attempt+1}/3)")
             time.sleep(2)  # short wait before retry
 
 # -------------------------
-# Main process and upload
+# Batched commit queue
 # -------------------------
-def process_and_upload(audio_array, sample_rate, transcript, speaker_id=None, language=None):
-    entry_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().isoformat() + "Z"
-    audio_filename = f"{REPO_SUBFOLDER}/{entry_id}.flac"
-    json_filename = f"{REPO_SUBFOLDER}/{entry_id}.json"
+# Every commit has a fixed cost on the Hub, so submissions are queued as rows
+# and flushed together as a single parquet shard in one commit. All flushes but
+# the final one run on a single long-lived worker thread.
+pending_rows = []
+pending_lock = threading.Lock()
+flush_requested = threading.Event()
+shutting_down = threading.Event()
+
+
+def spill_rows(shard_name, shard_bytes):
+    """Save a shard to SPILL_DIR and return its path."""
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    spill_path = os.path.abspath(os.path.join(SPILL_DIR, shard_name))
+    with open(spill_path, "wb") as f:
+        f.write(shard_bytes)
+    return spill_path
+
+
+def take_pending_rows():
+    with pending_lock:
+        rows = pending_rows[:]
+        pending_rows.clear()
+    return rows
+
+
+def commit_rows(rows):
+    """Commit rows as one parquet shard.
+
+    The shard is spilled to disk first, so a kill during the (retried) commit leaves it
+    in SPILL_DIR instead of losing it. A failed batch is re-queued, unless the app is
+    shutting down and no later flush would pick it up: then the spilled shard is kept.
+    """
+    shard_name = f"chunk-{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}.parquet"
+    shard_bytes = write_parquet_shard(rows)
+    spill_path = spill_rows(shard_name, shard_bytes)
+    try:
+        safe_commit([(f"{SHARD_SUBFOLDER}/{shard_name}", shard_bytes)])
+    except Exception as e:
+        if shutting_down.is_set():
+            print(f"Batch commit failed during shutdown, saved {len(rows)} submissions to {spill_path}: {e}")
+            return
+        # The rows get a fresh spill file on their next attempt
+        os.remove(spill_path)
+        print(f"Batch commit failed, re-queueing {len(rows)} submissions: {e}")
+        with pending_lock:
+            pending_rows[:0] = rows
+        return
+    os.remove(spill_path)
+
+
+def commit_worker():
+    """Flush the queue every COMMIT_INTERVAL seconds, or sooner once a batch is full."""
+    while not shutting_down.is_set():
+        flush_requested.wait(timeout=COMMIT_INTERVAL)
+        flush_requested.clear()
+        if shutting_down.is_set():
+            break
+        rows = take_pending_rows()
+        if rows:
+            commit_rows(rows)
+
+
+def flush_final():
+    """Commit whatever is still queued at shutdown.
+
+    A batch the worker is committing right now is already in SPILL_DIR, so it survives
+    even if the worker is killed before its commit finishes.
+    """
+    shutting_down.set()
+    flush_requested.set()
+    rows = take_pending_rows()
+    if rows:
+        commit_rows(rows)
+
+
+def queue_row(row):
+    """Add a submission to the next shard, waking the worker once the batch is full."""
+    with pending_lock:
+        pending_rows.append(row)
+        batch_full = len(pending_rows) >= COMMIT_BATCH_ROWS
+    if batch_full:
+        flush_requested.set()
+
+
+def on_sigterm(signum, frame):
+    # Python does not run atexit handlers on SIGTERM (container/Space restarts), so flush here
+    flush_final()
+    sys.exit(0)
+
+
+if os.path.isdir(SPILL_DIR) and os.listdir(SPILL_DIR):
+    print(f"NOTE: {os.path.abspath(SPILL_DIR)} holds shards from an earlier run that may not have "
+          f"been committed; upload any that are missing from {REPO_ID} by hand.")
+
+threading.Thread(target=commit_worker, name="hub-commit-worker", daemon=True).start()
+# Commit whatever is still queued when the app shuts down
+atexit.register(flush_final)
+signal.signal(signal.SIGTERM, on_sigterm)
 
-    # --- Convert audio to FLAC to reduce size and prevent timeout ---
+# -------------------------
+# Main process and upload
+# -------------------------
+def block_dtype(src):
+    """Pick the dtype to stream `src` in.
+
+    libsndfile does not scale float samples when they are read as integers (a float WAV
+    would come back as all zeros), so int16 is only used when the source already is
+    16-bit PCM; everything else goes through float32, which it scales into PCM_16 on write.
+    """
+    return "int16" if src.subtype == "PCM_16" else "float32"
+
+
+def find_voiced_range(src, dtype, blocksize=8192):
+    """Return the (start, stop) frames spanning every sample louder than SILENCE_THRESHOLD."""
+    threshold = SILENCE_THRESHOLD if dtype == "int16" else SILENCE_THRESHOLD / 32768
+    start, stop = None, None
+    offset = 0
+    for block in src.blocks(blocksize=blocksize, dtype=dtype, always_2d=True):
+        # Compare against both signs instead of np.abs, which overflows on int16 -32768
+        voiced = ((block > threshold) | (block < -threshold)).any(axis=1)
+        if voiced.any():
+            if start is None:
+                start = offset + int(voiced.argmax())
+            stop = offset + len(voiced) - int(voiced[::-1].argmax())
+        offset += len(block)
+
+    if start is None:
+        # Nothing above the threshold: keep the clip as-is rather than uploading an empty one
+        return 0, offset
+    return start, stop
+
+
+def encode_flac(audio_path):
+    """Transcode a recording to FLAC bytes block by block, so only one block is ever held in memory.
+
+    Returns None for a recording without any frames.
+    """
     buf = io.BytesIO()
-    sf.write(buf, audio_array, samplerate=sample_rate, format="FLAC")
-    buf.seek(0)
+    with sf.SoundFile(audio_path) as src:
+        dtype = block_dtype(src)
+        # Leading/trailing silence only inflates the upload, so encode the voiced range only
+        start, stop = find_voiced_range(src, dtype)
+        if stop == start:
+            # libsndfile would produce an empty, undecodable file
+            return None
+        src.seek(start)
+        with sf.SoundFile(
+            buf, mode="w", samplerate=src.samplerate, channels=src.channels,
+            format="FLAC", subtype="PCM_16",
+            # soundfile takes the compression level as 0.0 .. 1.0, mapped linearly onto libFLAC's 0 .. 8
+            compression_level=FLAC_LEVEL / 8
+        ) as dst:
+            for block in src.blocks(blocksize=8192, frames=stop - start, dtype=dtype):
+                if dtype == "float32":
+                    # libsndfile wraps rather than clips out-of-range floats when converting to PCM
+                    np.clip(block, -1.0, 1.0, out=block)
+                dst.write(block)
+    return buf.getvalue()
+
+
+def process_and_upload(audio_path, transcript, speaker_id=None, language=None):
+    entry_id = uuid.uuid4().hex
+    timestamp = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
 
-    # Upload audio safely
-    safe_upload(buf, audio_filename)
+    # --- Convert audio to FLAC to reduce size and prevent timeout ---
+    flac_bytes = encode_flac(audio_path)
+    if flac_bytes is None:
+        return False, "The recording is empty. Please record again."
 
-    # --- Prepare metadata JSON ---
-    meta = {
+    # --- Queue the submission as one row of the next parquet shard ---
+    queue_row({
         "id": entry_id,
-        "audio": audio_filename,
+        "audio": {"bytes": flac_bytes, "path": f"{entry_id}.flac"},
         "transcript": transcript,
         "speaker_id": speaker_id,
         "language": language,
         "timestamp": timestamp
-    }
-    meta_bytes = io.BytesIO(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
-    meta_bytes.seek(0)
-
-    # Upload metadata safely
-    safe_upload(meta_bytes, json_filename)
+    })
 
-    return True, f"Uploaded: {entry_id}"
+    return True, f"Queued for upload: {entry_id}"
 
 # -------------------------
 # Gradio submit function
 # -------------------------
-def on_submit(audio_path, transcript, speaker_id="", language=""):
+async def on_submit(audio_path, transcript, speaker_id="", language=""):
     if audio_path is None or not transcript.strip():
         return "Please record audio and type transcript."
-    arr, sr = sf.read(audio_path, dtype="float32")
-    success, msg = process_and_upload(arr, sr, transcript, speaker_id, language)
+
+    # Encoding runs on a worker thread so the event loop stays free for other browsers;
+    # the upload itself happens later through the batched commit queue
+    loop = asyncio.get_running_loop()
+    try:
+        # Rejected recordings (e.g. empty ones) come back with success=False and are not queued
+        success, msg = await loop.run_in_executor(
+            None, process_and_upload, audio_path, transcript, speaker_id, language
+        )
+    except Exception as e:
+        raise gr.Error(f"Could not process the recording: {e}")
     return msg
 
 # -------------------------
@@ -239,4 +462,4 @@ with gr.Blocks() as demo:
         outputs=[status_output]
     )
 
-demo.launch(share=True)
+demo.queue(default_concurrency_limit=SUBMIT_CONCURRENCY).launch(share=True)
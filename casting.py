@@ -1,14 +1,24 @@
 # casting.py
 # Script to cast the "audio" column of your Hugging Face dataset
 # for proper playable audio in the data card.
+# Only needed for submissions stored as separate .flac + .json files under data/: app.py
+# now uploads parquet shards (with an Audio "audio" column) to APP_SHARD_DIR, which the
+# dataset card written here adds to the train split.
 
 import os
+import argparse
+# Enable chunk-level dedup for Xet-backed uploads; must be set before huggingface_hub is imported
+os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+
 import shutil
 import logging
-from datasets import load_dataset, Audio 
-from datasets import unresolve_features # FIX: Import context manager from top-level datasets module
-from huggingface_hub import hf_hub_download
-from huggingface_hub.utils import RepositoryNotFoundError 
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm.auto import tqdm
+from datasets import load_dataset, Audio, DatasetDict
+from datasets.table import embed_table_storage
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, DatasetCard, HfApi, hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError, RepositoryNotFoundError 
 
 # --- STANDARD PYTHON LOGGING SETUP ---
 # This will output detailed debug information to the console to help diagnose download issues.
@@ -22,13 +32,129 @@ REPO_ID = "IbraahimLab/Voice-so-data"
 # FIX: Removed invisible character U+00A0
 REPO_SUBFOLDER = "tmp_audio_root" # Temporary folder for Hub download cache
 REPO_LOCAL_STORAGE = os.path.join(REPO_SUBFOLDER, REPO_ID.split('/')[-1]) 
-LOCAL_CWD_DATA_DIR = "data" # The folder where the push function expects to find the audio files
+PARQUET_EXPORT_DIR = os.path.join(REPO_SUBFOLDER, "parquet_export") # Local mirror of the parquet files to upload
+NUM_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+ROWS_PER_SHARD = 2000 # Fewer, larger parquet shards mean fewer files to commit
+APP_SHARD_DIR = "submissions" # Must match HF_SHARD_SUBFOLDER in app.py
+DOWNLOAD_WORKERS = 32 # Downloads are network-bound, so use far more threads than cores
+DOWNLOAD_RETRIES = 5 # Attempts per file; transient 429s/timeouts are likely at this concurrency
+
+# --- PARQUET EXPORT ---
+def write_parquet_shards(dataset_split, split_name):
+    """Write one split as parquet shards (audio bytes embedded) in parallel."""
+    num_shards = max(1, len(dataset_split) // ROWS_PER_SHARD)
+    os.makedirs(os.path.join(PARQUET_EXPORT_DIR, "data"), exist_ok=True)
+
+    def write_shard(index):
+        shard = dataset_split.shard(num_shards=num_shards, index=index, contiguous=True)
+        # Embed the audio file bytes so the shard is self-contained (same as push_to_hub does);
+        # keep_in_memory avoids writing a second copy of the audio to the datasets cache
+        shard = shard.with_format("arrow").map(embed_table_storage, batched=True, keep_in_memory=True)
+        shard_path = os.path.join(PARQUET_EXPORT_DIR, "data", f"{split_name}-{index:05d}-of-{num_shards:05d}.parquet")
+        shard.to_parquet(shard_path)
+        return shard_path
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as ex:
+        return list(ex.map(write_shard, range(num_shards)))
+
+
+def build_dataset_card(dataset):
+    """Return the repo's README.md with the default config pointed at the parquet shards.
+
+    Like push_to_hub, the existing card is loaded and updated, so its prose and any
+    other configs are kept.
+    """
+    try:
+        card = DatasetCard.load(REPO_ID, repo_type="dataset")
+    except EntryNotFoundError:
+        card = DatasetCard("")
+
+    data_files = [
+        {"split": split_name, "path": [f"data/{split_name}-*"]} for split_name in dataset.keys()
+    ]
+    # Shards uploaded by app.py always belong to the train split
+    app_shards = f"{APP_SHARD_DIR}/*.parquet"
+    train_files = next((entry for entry in data_files if entry["split"] == "train"), None)
+    if train_files is None:
+        data_files.append({"split": "train", "path": [app_shards]})
+    else:
+        train_files["path"].append(app_shards)
+    default_config = {"config_name": "default", "data_files": data_files}
+    other_configs = [
+        config for config in (card.data.get("configs") or [])
+        if config.get("config_name") != "default"
+    ]
+    card.data.configs = [default_config] + other_configs
+
+    feature_list = []
+    features = next(iter(dataset.values())).features
+    for name, feature in features.items():
+        if isinstance(feature, Audio):
+            dtype = "audio"
+        elif hasattr(feature, "dtype"):
+            dtype = feature.dtype
+        else:
+            # Nested features are described by the schema metadata stored in the parquet files
+            continue
+        feature_list.append({"name": name, "dtype": dtype})
+    card.data.dataset_info = {"features": feature_list}
+
+    return str(card)
+
+
+def list_stale_shards(api, dataset, new_shard_paths):
+    """Return the repo's data/{split}-* files that the new upload does not overwrite."""
+    prefixes = tuple(f"data/{split_name}-" for split_name in dataset.keys())
+    return [
+        path for path in api.list_repo_files(REPO_ID, repo_type="dataset")
+        if path.startswith(prefixes) and path not in new_shard_paths
+    ]
+
+
+# --- AUDIO DOWNLOAD ---
+def download_audio_file(audio_filename_in_repo):
+    """Download one audio file into REPO_LOCAL_STORAGE; returns its local path, or None on failure.
+
+    Raises EntryNotFoundError right away (without retrying) if the file does not exist in the repo.
+    """
+    # 1. Define the expected absolute path of the downloaded file (where it will be placed by hf_hub_download)
+    local_cache_path = os.path.join(REPO_LOCAL_STORAGE, audio_filename_in_repo.replace('/', os.sep))
+
+    if os.path.exists(local_cache_path):
+        return local_cache_path
+
+    # Ensure the final target directory exists
+    os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
+
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            # Explicitly set repo_type="dataset" to resolve the 404 error
+            # hf_hub_download returns the absolute path to the downloaded file
+            return hf_hub_download(
+                repo_id=REPO_ID, 
+                filename=audio_filename_in_repo, 
+                local_dir=REPO_LOCAL_STORAGE,
+                repo_type="dataset" 
+            )
+        except EntryNotFoundError:
+            # Permanent: e.g. a JSON record whose audio upload never made it; retrying can't help
+            raise
+        except Exception as download_e:
+            if attempt < DOWNLOAD_RETRIES - 1:
+                print(f"Download of {audio_filename_in_repo} failed, retrying... ({attempt+1}/{DOWNLOAD_RETRIES})")
+                time.sleep(2 ** attempt)  # exponential backoff before retry
+                continue
+            print("\n" + "*"*50)
+            print(f"CRITICAL DOWNLOAD FAILED: {audio_filename_in_repo}")
+            print(f"ACTUAL EXCEPTION DETAIL: {download_e}")
+            print("*"*50 + "\n")
+            return None
+
 
 # --- DATASET PROCESSING ---
-def process_dataset():
-    # Make sure temporary folder exists and the local data dir exists
+def process_dataset(drop_missing_audio=False):
+    # Make sure temporary folder exists
     os.makedirs(REPO_LOCAL_STORAGE, exist_ok=True)
-    os.makedirs(LOCAL_CWD_DATA_DIR, exist_ok=True)
     
     try:
         print(f"Attempting to load dataset: {REPO_ID}")
@@ -39,101 +165,139 @@ def process_dataset():
         shutil.rmtree(REPO_SUBFOLDER, ignore_errors=True)
         return 
 
+    # Once a previous run has written the card, the dataset loads from the parquet shards with
+    # "audio" already an Audio feature: nothing is left to cast, so only refresh the card
+    if any(isinstance(dataset[split].features.get("audio"), Audio) for split in dataset.keys()):
+        print("The 'audio' column is already cast; only refreshing the dataset card...")
+        HfApi().upload_file(
+            path_or_fileobj=build_dataset_card(dataset).encode("utf-8"),
+            path_in_repo="README.md",
+            repo_id=REPO_ID,
+            repo_type="dataset",
+            commit_message="Update dataset card"
+        )
+        shutil.rmtree(REPO_SUBFOLDER, ignore_errors=True)
+        print("Dataset card updated.")
+        return
+
     # Download missing audio files from the Hub
     print("Downloading audio files temporarily for casting...")
-    
-    downloaded_paths = {}
-    
-    # Use unresolve_features to force iteration to return the raw string path,
-    # preventing the Audio feature from attempting to decode the file (and failing the string methods).
-    with unresolve_features(dataset.features):
-        for split in dataset.keys():
-            for row in dataset[split]:
-                # This is now reliably the string path (e.g., 'data/file.wav')
-                audio_filename_in_repo = row['audio']
-                
-                # 1. Define the expected absolute path of the downloaded file (where it will be placed by hf_hub_download)
-                local_cache_path = os.path.join(REPO_LOCAL_STORAGE, audio_filename_in_repo.replace('/', os.sep))
-                
-                # Ensure the final target directory exists
-                os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
-
-                # Use a combined key for the downloaded_paths dict to ensure uniqueness across splits
-                key = f"{split}/{audio_filename_in_repo}"
-
-                if not os.path.exists(local_cache_path):
-                    try:
-                        # Explicitly set repo_type="dataset" to resolve the 404 error
-                        # hf_hub_download returns the absolute path to the downloaded file
-                        downloaded_file_path = hf_hub_download(
-                            repo_id=REPO_ID, 
-                            filename=audio_filename_in_repo, 
-                            local_dir=REPO_LOCAL_STORAGE,
-                            repo_type="dataset" 
-                        )
-                        downloaded_paths[key] = downloaded_file_path
-                    
-                    except Exception as download_e:
-                        print("\n" + "*"*50)
-                        print(f"CRITICAL DOWNLOAD FAILED: {audio_filename_in_repo}")
-                        print(f"ACTUAL EXCEPTION DETAIL: {download_e}")
-                        print("*"*50 + "\n")
-                        continue
-                else:
-                    downloaded_paths[key] = local_cache_path
+
+    # Collect the unique repo paths straight from the Arrow "audio" column instead of iterating rows.
+    # The column still holds plain string paths here (e.g., 'data/file.flac').
+    audio_filenames_in_repo = sorted({
+        filename for split in dataset.keys() for filename in dataset[split].unique("audio")
+    })
+
+    # Repo path -> absolute local path, filled in as each download completes
+    rewrite_map = {}
+    # Repo paths referenced by a row but absent from the repo
+    not_in_repo = set()
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futures = {
+            ex.submit(download_audio_file, audio_filename_in_repo): audio_filename_in_repo
+            for audio_filename_in_repo in audio_filenames_in_repo
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading audio"):
+            try:
+                downloaded_file_path = future.result()
+            except EntryNotFoundError:
+                not_in_repo.add(futures[future])
+                continue
+            if downloaded_file_path is not None:
+                rewrite_map[futures[future]] = os.path.abspath(downloaded_file_path)
 
     print("Download completed.")
 
-    # Update dataset paths to point to local files AND copy files to CWD expected location
-    print("Preparing local files and updating dataset paths...")
-    updated_dataset = dataset.copy() 
-
-    # Use unresolve_features again for the second iteration loop
-    with unresolve_features(updated_dataset.features):
-        for split in updated_dataset.keys():
-            for i, row in enumerate(updated_dataset[split]):
-                # This is now reliably the string path (e.g., 'data/file.wav')
-                audio_filename_in_repo = row['audio']
-                
-                key = f"{split}/{audio_filename_in_repo}"
-                
-                if key in downloaded_paths:
-                    source_path = downloaded_paths[key]
-                    
-                    # The absolute path the 'push_to_hub' function expects to find the local file at (CWD/data/file.wav)
-                    expected_cwd_path = os.path.join(os.getcwd(), audio_filename_in_repo.replace('/', os.sep))
-
-                    # Copy the file from the temporary cache to the expected CWD path (FIX for WinError 3)
-                    try:
-                        # Ensure the expected CWD path directory exists
-                        os.makedirs(os.path.dirname(expected_cwd_path), exist_ok=True)
-                        # Use copy2 to preserve metadata (useful for mtime)
-                        shutil.copy2(source_path, expected_cwd_path) 
-                    except Exception as copy_e:
-                        print(f"WARNING: Failed to copy file to CWD: {expected_cwd_path}. Push may fail. Details: {copy_e}")
-                        
-                    # Update the dataset column to use the absolute path of the file we just copied.
-                    # This path is required for the local Audio() feature to load the file successfully.
-                    updated_dataset[split][i]['audio'] = os.path.abspath(expected_cwd_path)
-                else:
-                    # If the download failed, we skip updating the path.
-                    pass 
+    # Publishing without rows whose download failed transiently would permanently shrink the
+    # dataset on the Hub, so stop instead
+    failed = [
+        filename for filename in audio_filenames_in_repo
+        if filename not in rewrite_map and filename not in not_in_repo
+    ]
+    if failed:
+        print("\n" + "="*70)
+        print(f"FATAL ERROR: {len(failed)} audio file(s) could not be downloaded. Nothing was pushed.")
+        print("Re-run the script to retry; files already downloaded are reused.")
+        print("="*70 + "\n")
+        return
+
+    # Rows pointing at audio that does not exist in the repo fail the same way on every run,
+    # so they are only dropped when asked for explicitly
+    if not_in_repo:
+        print("\n" + "="*70)
+        print(f"{len(not_in_repo)} row(s) reference audio files that do not exist in {REPO_ID}:")
+        for filename in sorted(not_in_repo):
+            print(f"  {filename}")
+        if not drop_missing_audio:
+            print("FATAL ERROR: Nothing was pushed. Re-run with --drop-missing-audio to publish without these rows.")
+            print("="*70 + "\n")
+            return
+        print("Dropping these rows (--drop-missing-audio).")
+        print("="*70 + "\n")
+        dataset = dataset.filter(
+            lambda batch: [path not in not_in_repo for path in batch["audio"]],
+            batched=True, batch_size=2048, num_proc=NUM_WORKERS
+        )
+
+    # Point the dataset paths straight at the downloaded files; Audio() loads from any absolute path
+    print("Updating dataset paths...")
+
+    def rewrite_audio_paths(batch):
+        batch["audio"] = [rewrite_map[path] for path in batch["audio"]]
+        return batch
+
+    # map never mutates in place, so the rewritten splits form a new DatasetDict (no copy() needed)
+    updated_dataset = DatasetDict({
+        split: dataset[split].map(
+            rewrite_audio_paths, batched=True, batch_size=2048, num_proc=NUM_WORKERS
+        )
+        for split in dataset.keys()
+    })
 
     # Cast the "audio" column to proper Audio type
     print("Casting 'audio' column...")
-    # Iterate over all splits to apply cast_column
-    for split in updated_dataset.keys():
-        updated_dataset[split] = updated_dataset[split].cast_column("audio", Audio())
+    # DatasetDict applies the (metadata-only) cast to every split at once
+    updated_dataset = updated_dataset.cast_column("audio", Audio())
 
     # Push the cast dataset back to the Hub
     print(f"Pushing dataset with cast audio back to Hugging Face repository: {REPO_ID}...")
     try:
-        # Iterate over splits and push them individually (FIX for 'dict' object error in old versions)
+        # Write every split as parquet shards
+        local_shard_paths = []
         for split_name, dataset_split in updated_dataset.items():
-            print(f"Pushing split '{split_name}'...")
-            # Use split=split_name to correctly update the remote split
-            dataset_split.push_to_hub(REPO_ID, split=split_name)
-        
+            print(f"Writing parquet shards for split '{split_name}'...")
+            local_shard_paths += write_parquet_shards(dataset_split, split_name)
+
+        # Add the new shards and card and delete shards left over from earlier runs (whose shard
+        # count may differ) in one commit, so the data/{split}-* globs never match duplicate rows
+        api = HfApi()
+        operations = [
+            CommitOperationAdd(
+                path_in_repo=os.path.relpath(local_path, PARQUET_EXPORT_DIR).replace(os.sep, '/'),
+                path_or_fileobj=local_path
+            )
+            for local_path in local_shard_paths
+        ]
+        new_shard_paths = {operation.path_in_repo for operation in operations}
+        operations += [
+            CommitOperationDelete(path_in_repo=path)
+            for path in list_stale_shards(api, updated_dataset, new_shard_paths)
+        ]
+        operations.append(CommitOperationAdd(
+            path_in_repo="README.md",
+            path_or_fileobj=build_dataset_card(updated_dataset).encode("utf-8")
+        ))
+
+        api.create_commit(
+            repo_id=REPO_ID,
+            repo_type="dataset",
+            operations=operations,
+            commit_message="Upload cast dataset as parquet shards",
+            num_threads=NUM_WORKERS
+        )
+
         print("Dataset successfully updated on Hugging Face!")
     except Exception as push_e:
         print("\n" + "="*70)
@@ -145,10 +309,14 @@ def process_dataset():
 
     # Clean up temporary audio files
     shutil.rmtree(REPO_SUBFOLDER, ignore_errors=True)
-    # Also clean up the files copied to the CWD data folder
-    shutil.rmtree(LOCAL_CWD_DATA_DIR, ignore_errors=True) 
     print("Temporary files cleaned up.")
 
 # Run the process
 if __name__ == '__main__':
-    process_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=f"Cast the audio column of {REPO_ID} and push it back.")
+    parser.add_argument(
+        "--drop-missing-audio", action="store_true",
+        help="publish without rows whose audio file does not exist in the repo instead of aborting"
+    )
+    args = parser.parse_args()
+    process_dataset(drop_missing_audio=args.drop_missing_audio)
\ No newline at end of file